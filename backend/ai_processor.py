@@ -1,16 +1,54 @@
 # ai_processor.py
-import os, json, re, traceback
-from typing import List, Dict, Any, Optional
-from openai import OpenAI
+import os, re, traceback, asyncio, hashlib
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
+import httpx
+import ijson
+from openai import AsyncOpenAI
+
+import semantic_cache
+
+MAX_FIELDS = 120
+
+# Concurrent uploads are coalesced into one model call: requests arriving
+# within BATCH_WINDOW_SECONDS of each other (up to BATCH_MAX_DOCS) share a prompt.
+BATCH_WINDOW_SECONDS = 0.2
+BATCH_MAX_DOCS = 4
+
+# Each model call covers at most CHUNK_SIZE fields; chunks run in parallel.
+CHUNK_SIZE = 15
+
+# Guidance for a field depends only on its type, label guess and local context,
+# so standard templates re-use earlier answers instead of calling the model.
+GUIDANCE_CACHE_MAX = 5000
+_guidance_cache: Dict[str, Dict[str, str]] = {}
+
+_DOC_LABEL_RE = re.compile(r"doc\d+$")
+
+# One client per process: keeps TLS connections alive and multiplexes the
+# parallel chunk requests over HTTP/2.
+_client: Optional[AsyncOpenAI] = None
+
+def _get_client() -> AsyncOpenAI:
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+                timeout=httpx.Timeout(120.0, connect=10.0),
+            ),
+        )
+    return _client
 
 SYSTEM = (
-    "You generate clear guidance for users filling form fields in three formats: "
-    "1) MICRO: A 3-5 word concise label/description "
-    "2) LONG: A 3-5 sentence detailed explanation "
-    "3) DEMO: A realistic example value that could be used as sample data "
+    "You generate clear guidance for users filling form fields. For each field give: "
+    "MICRO, a 3-5 word label (e.g. \"Company legal name\"); "
+    "LONG, 3-5 sentences on what to enter and why; "
+    "DEMO, a realistic sample value (e.g. \"Acme Corporation LLC\", \"$500,000\"). "
     "Be concise, concrete, and actionable. Avoid legalese and fluff. "
-    "Use the per-field local context and the optional label_guess to tailor the advice. "
-    "Always respond with STRICT JSON only."
+    "Fields are grouped by document (doc1, doc2, ...); use each field's local context and label_guess "
+    "to distinguish similarly named blanks. Answer as JSON: document label -> field id -> guidance."
 )
 
 def trim(text: str, max_chars: int = 900) -> str:
@@ -19,176 +57,362 @@ def trim(text: str, max_chars: int = 900) -> str:
     head, tail = text[:max_chars//2], text[-max_chars//2:]
     return head + " … " + tail
 
-def _format_prompt(filename: str, placeholders: List[Dict[str, Any]]) -> str:
-    MAX_FIELDS = 120
-    phs = placeholders[:MAX_FIELDS]
-    
-    lines = []
-    for i, p in enumerate(phs, 1):
-        key_text = p["value"] if p["type"] == "bracketed" else f'{p["label"]}:'
-        lines.append(
-            f'{i}. id="{p["id"]}" | key="{key_text}" | line={p["line"]} | label_guess="{p.get("label_guess","")}"\n'
-            f'   context: {trim(p.get("context",""))}'
-        )
+def _format_prompt(docs: List[Tuple[str, str, List[Dict[str, Any]]]]) -> str:
+    """
+    Build one prompt covering several documents.
+    docs: [(doc_label, filename, placeholders), ...]
+    """
+    sections = []
+    for label, filename, placeholders in docs:
+        phs = placeholders[:MAX_FIELDS]
 
-    schema_hint = (
-        "{\n"
-        '  "id1": {\n'
-        '    "micro": "3-5 words",\n'
-        '    "long": "3-5 sentences explaining what to enter...",\n'
-        '    "demo": "realistic example value"\n'
-        '  },\n'
-        '  "id2": {\n'
-        '    "micro": "3-5 words",\n'
-        '    "long": "3-5 sentences explaining what to enter...",\n'
-        '    "demo": "realistic example value"\n'
-        '  },\n'
-        "  ...\n"
-        "}"
-    )
+        lines = [f"=== DOC {label}: {filename} ==="]
+        for i, p in enumerate(phs, 1):
+            key_text = p["value"] if p["type"] == "bracketed" else f'{p["label"]}:'
+            lines.append(
+                f'{i}. id="{p["id"]}" | key="{key_text}" | line={p["line"]} | label_guess="{p.get("label_guess","")}"\n'
+                f'   context: {trim(p.get("context",""))}'
+            )
+        sections.append(chr(10).join(lines))
+
+    return chr(10).join(sections)
+
+def _response_schema(docs: List[Tuple[str, str, List[Dict[str, Any]]]]) -> Dict[str, Any]:
+    """Strict JSON schema naming exactly the doc labels and field ids in this prompt."""
+    guidance = {
+        "type": "object",
+        "properties": {
+            "micro": {"type": "string"},
+            "long": {"type": "string"},
+            "demo": {"type": "string"},
+        },
+        "required": ["micro", "long", "demo"],
+        "additionalProperties": False,
+    }
+    doc_props = {}
+    for label, _, placeholders in docs:
+        ids = [p["id"] for p in placeholders[:MAX_FIELDS]]
+        doc_props[label] = {
+            "type": "object",
+            "properties": {field_id: guidance for field_id in ids},
+            "required": ids,
+            "additionalProperties": False,
+        }
+    return {
+        "type": "object",
+        "properties": doc_props,
+        "required": list(doc_props),
+        "additionalProperties": False,
+    }
+
+class _FieldStreamParser:
+    """
+    Incrementally parse streamed model output of the form
+    {"doc1": {"<field id>": {"micro": ..., "long": ..., "demo": ...}, ...}, ...}
+    and hand back each field object as soon as its closing brace arrives.
+    Yields (doc_label, key, obj); doc_label is None when the model skipped the doc wrapper.
+    """
 
-    prompt = f"""
-Document: {filename}
-
-For each FIELD below, provide THREE types of guidance:
-1. MICRO: A concise 3-5 word label/description (e.g., "Company legal name", "Investment amount", "Founder signature")
-2. LONG: A detailed 3-5 sentence explanation guiding the user on WHAT to enter and WHY
-3. DEMO: A realistic example value that could be used as sample/demo data (e.g., "Acme Corporation LLC", "$500,000", "John Smith")
-
-Use the local context and the label_guess to distinguish similarly named blanks.
-Return STRICT JSON mapping from field id -> object with "micro", "long", and "demo" keys (no code fences, no prose).
-
-FIELDS:
-{chr(10).join(lines)}
-
-Return JSON exactly like:
-{schema_hint}
-""".strip()
-    
-    return prompt
-
-def _extract_json(text: str) -> Optional[Dict[str, Any]]:
-    if not text:
-        return None
-    
-    t = text.strip()
-    
-    if t.startswith("```"):
-        t = re.sub(r"^```(?:json)?\s*|\s*```$", "", t, flags=re.IGNORECASE)
-    
-    s, e = t.find("{"), t.rfind("}")
-    if s != -1 and e != -1 and e > s:
+    def __init__(self):
+        self._events = ijson.sendable_list()
+        self._coro = ijson.parse_coro(self._events)
+        self._started = False
+        self._builder = None
+        self._path = None
+        self.failed = False
+
+    def feed(self, text: str) -> List[Tuple[Optional[str], str, Any]]:
+        if self.failed:
+            return []
+        if not self._started:
+            # Skip code fences / prose before the JSON body
+            start = text.find("{")
+            if start == -1:
+                return []
+            text, self._started = text[start:], True
         try:
-            json_str = t[s:e+1]
-            result = json.loads(json_str)
-            return result
-        except Exception:
-            return None
-    
-    return None
+            self._coro.send(text.encode("utf-8"))
+        except ijson.JSONError:
+            # Truncated or trailing garbage: keep whatever fields completed before it
+            self.failed = True
+        return self._drain()
 
-def _call_model(client: OpenAI, prompt: str) -> Dict[str, Any]:
-    # Try Responses API with enforced JSON
-    try:
-        r = client.responses.create(
-            model="gpt-5-mini",
-            input=prompt,
-            max_output_tokens=6000,
-        )
-        
-        raw = (r.output_text or "").strip() if hasattr(r, 'output_text') else ""
-        if not raw and hasattr(r, 'output'):
-            raw = str(r.output).strip()
-        if not raw:
-            for attr in ['text', 'content', 'response', 'result']:
-                if hasattr(r, attr):
-                    raw = str(getattr(r, attr)).strip()
-                    if raw:
-                        break
-        
-        if raw:
+    def close(self) -> List[Tuple[Optional[str], str, Any]]:
+        if self._started and not self.failed:
             try:
-                parsed = json.loads(raw)
-                return parsed
-            except json.JSONDecodeError:
-                try:
-                    if not raw.rstrip().endswith('}'):
-                        last_comma = raw.rfind(',')
-                        if last_comma > 0:
-                            fixed = raw[:last_comma] + "\n}"
-                            parsed = json.loads(fixed)
-                            return parsed
-                except Exception:
-                    pass
-        
-        alt = _extract_json(getattr(r, "output", "") or "")
-        if alt:
-            return alt
+                self._coro.close()
+            except ijson.JSONError:
+                self.failed = True
+        return self._drain()
+
+    def _drain(self) -> List[Tuple[Optional[str], str, Any]]:
+        done = []
+        for prefix, event, value in self._events:
+            if self._builder is None and event == "start_map" and prefix:
+                parts = prefix.split(".")
+                if len(parts) == 2 or (len(parts) == 1 and not _DOC_LABEL_RE.match(parts[0])):
+                    self._builder, self._path = ijson.ObjectBuilder(), prefix
+            if self._builder is None:
+                continue
+            self._builder.event(event, value)
+            if event == "end_map" and prefix == self._path:
+                parts = self._path.split(".")
+                doc_label, key = (parts[0], parts[1]) if len(parts) == 2 else (None, parts[0])
+                done.append((doc_label, key, self._builder.value))
+                self._builder = self._path = None
+        del self._events[:]
+        return done
+
+async def _parse_stream(deltas: AsyncIterator[str]) -> AsyncIterator[Tuple[Optional[str], str, Any]]:
+    parser = _FieldStreamParser()
+    async for text in deltas:
+        for item in parser.feed(text):
+            yield item
+        if parser.failed:
+            return
+    for item in parser.close():
+        yield item
+
+async def _responses_deltas(client: AsyncOpenAI, prompt: str, schema: Dict[str, Any]) -> AsyncIterator[str]:
+    async with client.responses.stream(
+        model="gpt-5-mini",
+        instructions=SYSTEM,
+        input=prompt,
+        text={"format": {"type": "json_schema", "name": "field_guidance", "schema": schema, "strict": True}},
+        max_output_tokens=6000,
+    ) as stream:
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+
+async def _chat_deltas(client: AsyncOpenAI, prompt: str, schema: Dict[str, Any]) -> AsyncIterator[str]:
+    stream = await client.chat.completions.create(
+        model="gpt-5-mini",
+        messages=[
+            {"role":"system","content":SYSTEM},
+            {"role":"user","content": prompt}
+        ],
+        temperature=0.4,
+        max_completion_tokens=6000,
+        response_format={"type": "json_schema", "json_schema": {"name": "field_guidance", "schema": schema, "strict": True}},
+        stream=True,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def _stream_model(client: AsyncOpenAI, prompt: str, schema: Dict[str, Any]) -> AsyncIterator[Tuple[Optional[str], str, Any]]:
+    """Yield (doc_label, key, obj) for each field as the model finishes writing it."""
+    emitted = 0
+    # Try Responses API first
+    try:
+        async for item in _parse_stream(_responses_deltas(client, prompt, schema)):
+            emitted += 1
+            yield item
     except Exception:
         pass
+    if emitted:
+        return
 
     # Fallback: chat.completions
     try:
-        r = client.chat.completions.create(
-            model="gpt-5-mini",
-            messages=[
-                {"role":"system","content":SYSTEM},
-                {"role":"user","content": prompt + "\n\nReturn ONLY JSON (id->object with micro and long)."}
-            ],
-            temperature=0.4,
-            max_completion_tokens=6000,
-            response_format={"type": "json_object"}
-        )
-        
-        raw = ""
-        if r.choices[0].message.content:
-            raw = r.choices[0].message.content.strip()
-        elif hasattr(r.choices[0].message, 'reasoning_content') and r.choices[0].message.reasoning_content:
-            raw = str(r.choices[0].message.reasoning_content).strip()
-        
-        data = _extract_json(raw)
-        if data:
-            return data
+        async for item in _parse_stream(_chat_deltas(client, prompt, schema)):
+            yield item
+    except Exception:
+        pass
+
+def _normalize_guidance(g: Any) -> Optional[Dict[str, str]]:
+    if isinstance(g, dict) and "micro" in g and "long" in g:
+        return {
+            "micro": str(g["micro"]).strip(),
+            "long": str(g["long"]).strip(),
+            "demo": str(g.get("demo", "")).strip()
+        }
+    return None
+
+def _resolve_field_id(placeholders: List[Dict[str, Any]], key: str) -> Optional[str]:
+    """Map a response key to a placeholder ID: direct ID, else the 1-based field number."""
+    for p in placeholders:
+        if p["id"] == key:
+            return key
+    if key.isdigit() and 1 <= int(key) <= len(placeholders):
+        return placeholders[int(key) - 1]["id"]
+    return None
+
+# ---------- Request coalescing ----------
+
+_pending: Optional[asyncio.Queue] = None
+_worker: Optional[asyncio.Task] = None
+_inflight: set = set()
+
+def _ensure_worker() -> asyncio.Queue:
+    global _pending, _worker
+    if _worker is None or _worker.done():
+        _pending = asyncio.Queue()
+        _worker = asyncio.get_running_loop().create_task(_batch_worker(_pending))
+    return _pending
+
+async def _batch_worker(queue: asyncio.Queue) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+        while len(batch) < BATCH_MAX_DOCS:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # Flush in the background so the next window starts collecting immediately
+        task = loop.create_task(_flush_batch(batch))
+        _inflight.add(task)
+        task.add_done_callback(_inflight.discard)
+
+def _chunk_docs(docs: List[Tuple[str, str, List[Dict[str, Any]]]]) -> List[List[Tuple[str, str, List[Dict[str, Any]]]]]:
+    """Split the batch's fields into CHUNK_SIZE-sized prompts, keeping doc grouping."""
+    chunks = []
+    current: List[Tuple[str, str, List[Dict[str, Any]]]] = []
+    size = 0
+    for label, filename, placeholders in docs:
+        phs = placeholders[:MAX_FIELDS]
+        while phs:
+            take, phs = phs[:CHUNK_SIZE - size], phs[CHUNK_SIZE - size:]
+            current.append((label, filename, take))
+            size += len(take)
+            if size >= CHUNK_SIZE:
+                chunks.append(current)
+                current, size = [], 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def _run_chunk(client: AsyncOpenAI, chunk: List[Tuple[str, str, List[Dict[str, Any]]]], sinks: Dict[str, asyncio.Queue]) -> None:
+    """Stream one chunk's model output, pushing (field_id, guidance) to each doc's sink."""
+    phs_by_label = {label: placeholders for label, _, placeholders in chunk}
+    async for doc_label, key, obj in _stream_model(client, _format_prompt(chunk), _response_schema(chunk)):
+        # A lone document may come back without the doc wrapper
+        if doc_label is None and len(chunk) == 1:
+            doc_label = chunk[0][0]
+        placeholders = phs_by_label.get(doc_label)
+        guidance = _normalize_guidance(obj)
+        if placeholders is None or guidance is None:
+            continue
+        field_id = _resolve_field_id(placeholders, key)
+        if field_id:
+            sinks[doc_label].put_nowait((field_id, guidance))
+
+async def _flush_batch(batch: List[Tuple[asyncio.Queue, str, List[Dict[str, Any]]]]) -> None:
+    docs = [(f"doc{i}", filename, placeholders) for i, (_, filename, placeholders) in enumerate(batch, 1)]
+    sinks = {label: sink for (sink, _, _), (label, _, _) in zip(batch, docs)}
+    try:
+        client = _get_client()
+        await asyncio.gather(*[_run_chunk(client, c, sinks) for c in _chunk_docs(docs)])
     except Exception:
         pass
+    finally:
+        for sink in sinks.values():
+            sink.put_nowait(None)
+
+def _field_token(p: Dict[str, Any]) -> str:
+    """The field's own text: the bracket token, or the signature label."""
+    return (p.get("value") if p["type"] == "bracketed" else p.get("label")) or ""
 
-    return {}
+def _cache_key(p: Dict[str, Any]) -> str:
+    # The token must be part of the key: on short documents every field's context
+    # window spans the whole text, so context alone can't tell fields apart.
+    raw = f"{p['type']}|{_field_token(p)}|{p.get('label_guess','')}|{trim(p.get('context',''), 300)}"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
 
-def generate_field_guidance(filename: str, placeholders: List[Dict[str, Any]], pdf_path: Optional[str]=None) -> Dict[str, Dict[str, str]]:
+def _cache_put(key: str, guidance: Dict[str, str]) -> None:
+    if key not in _guidance_cache and len(_guidance_cache) >= GUIDANCE_CACHE_MAX:
+        # Evict the oldest entry (dicts keep insertion order)
+        _guidance_cache.pop(next(iter(_guidance_cache)))
+    _guidance_cache[key] = guidance
+
+def _semantic_text(p: Dict[str, Any], window: int = 150) -> str:
+    """Token first, then the context immediately around the field.
+
+    `trim` keeps the head and tail of the ±CONTEXT_CHARS snippet, which drops
+    the field itself; centre on the token instead (or the snippet's middle).
     """
-    Generate both micro and long guidance for each field.
-    Returns: Dict[field_id, {"micro": "...", "long": "...", "demo": "..."}]
+    token, context = _field_token(p), p.get("context", "")
+    at = context.find(token) if token else -1
+    mid = at + len(token) // 2 if at >= 0 else len(context) // 2
+    near = context[max(0, mid - window):mid + window]
+    return f"{token}\n{p['type']}: {p.get('label_guess','')}\n{near}"
+
+async def stream_field_guidance(filename: str, placeholders: List[Dict[str, Any]]) -> AsyncIterator[Tuple[str, Dict[str, str]]]:
+    """
+    Yield (field_id, {"micro": "...", "long": "...", "demo": "..."}) as soon as
+    each field's guidance is available: exact cache hits, then near-match
+    (semantic_cache) hits, then model output.
     """
     api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
-        return {}
+    if not api_key or not placeholders:
+        return
 
-    client = OpenAI(api_key=api_key)
-    prompt = _format_prompt(filename, placeholders)
-    data = _call_model(client, prompt)
+    # Fields sharing a cache key (same token and context, e.g. repeated signature
+    # blocks) are asked once: only the first ("canonical") one is prompted and its
+    # answer fans out to the group.
+    keys: Dict[str, str] = {}
+    groups: Dict[str, List[str]] = {}
+    uncached = []
+    for p in placeholders[:MAX_FIELDS]:
+        key = _cache_key(p)
+        if key in _guidance_cache:
+            yield p["id"], dict(_guidance_cache[key])
+        elif key in groups:
+            groups[key].append(p["id"])
+        else:
+            keys[p["id"]] = key
+            groups[key] = [p["id"]]
+            uncached.append(p)
 
-    # Map the response to placeholder IDs
-    guidance_by_id: Dict[str, Dict[str, str]] = {}
-    
-    # First try: direct ID lookup
-    for p in placeholders:
-        g = data.get(p["id"])
-        if isinstance(g, dict) and "micro" in g and "long" in g:
-            guidance_by_id[p["id"]] = {
-                "micro": g["micro"].strip(),
-                "long": g["long"].strip(),
-                "demo": g.get("demo", "").strip()
-            }
-    
-    # Second try: if no matches, assume model returned numeric keys
-    if not guidance_by_id:
-        for i, p in enumerate(placeholders[:120], 1):
-            g = data.get(str(i))
-            if isinstance(g, dict) and "micro" in g and "long" in g:
-                guidance_by_id[p["id"]] = {
-                    "micro": g["micro"].strip(),
-                    "long": g["long"].strip(),
-                    "demo": g.get("demo", "").strip()
-                }
-    
-    return guidance_by_id
\ No newline at end of file
+    # Near-match lookup: one batched embedding call for all remaining fields
+    vectors: Dict[str, Any] = {}
+    if uncached and semantic_cache.enabled():
+        try:
+            texts = [_semantic_text(p) for p in uncached]
+            embedded = await asyncio.to_thread(semantic_cache.embed, texts)
+            hits = await asyncio.to_thread(semantic_cache.lookup, embedded)
+            misses = []
+            for p, vec, hit in zip(uncached, embedded, hits):
+                if hit:
+                    _cache_put(keys[p["id"]], hit)
+                    for field_id in groups[keys[p["id"]]]:
+                        yield field_id, dict(hit)
+                else:
+                    vectors[p["id"]] = vec
+                    misses.append(p)
+            uncached = misses
+        except Exception:
+            pass
+
+    if uncached:
+        sink: asyncio.Queue = asyncio.Queue()
+        await _ensure_worker().put((sink, filename, uncached))
+        fresh = []
+        while True:
+            item = await sink.get()
+            if item is None:
+                break
+            field_id, guidance = item
+            _cache_put(keys[field_id], guidance)
+            if field_id in vectors:
+                fresh.append((vectors[field_id], guidance))
+            for dup_id in groups[keys[field_id]]:
+                yield dup_id, dict(guidance)
+        if fresh:
+            try:
+                await asyncio.to_thread(semantic_cache.add, fresh)
+            except Exception:
+                pass
+
+async def generate_field_guidance(filename: str, placeholders: List[Dict[str, Any]], pdf_path: Optional[str]=None) -> Dict[str, Dict[str, str]]:
+    """
+    Generate both micro and long guidance for each field.
+    Returns: Dict[field_id, {"micro": "...", "long": "...", "demo": "..."}]
+    """
+    return {field_id: guidance async for field_id, guidance in stream_field_guidance(filename, placeholders)}
@@ -1,55 +1,81 @@
 # detector.py
 import re
-from docx import Document
+import zipfile
+from lxml import etree
 
 CONTEXT_CHARS = 500  # left/right window
 
-def detect_placeholders(file_path):
-    doc = Document(file_path)
-    all_paragraphs = list(doc.paragraphs)
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                all_paragraphs.extend(cell.paragraphs)
+# Compiled once at import; reused for every placeholder/document.
+# Kept RE2-compatible (no backreferences/lookaround, inline flags only).
+_WS_RE = re.compile(r"[ \t]+")
+_NL_RE = re.compile(r"\n{3,}")
+_LABEL_RE = re.compile(r'([A-Z][A-Za-z]+(?: [A-Z][A-Za-z]+){0,4})\s*(?:\$?\[\s*[_A-Za-z0-9]*\s*\]|:)\b')
+# '(the Some Term)' or a Capitalized label before a bracket/colon, in one scan
+_LABEL_FUSED_RE = re.compile(
+    r'(?i:\(\s*the\s+(?P<paren>[^)â€â€œ"]+?)\s*\))'
+    r'|(?P<cap>[A-Z][A-Za-z]+(?: [A-Z][A-Za-z]+){0,4})\s*(?:\$?\[\s*[_A-Za-z0-9]*\s*\]|:)\b'
+)
+_BRACKET_RE = re.compile(r"\$?\[\s*[^\]\n]+\s*\]")
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+# Same hardening python-docx's oxml_parser applies: never expand entities.
+_XML_PARSER = etree.XMLParser(remove_blank_text=True, resolve_entities=False)
+_UNDERLINE_XPATH = etree.XPath(
+    'boolean(w:r/w:rPr/w:u[@w:val and @w:val != "none"])',
+    namespaces={"w": _W[1:-1]},
+)
 
-    para_texts = [p.text or "" for p in all_paragraphs]
-    full_text = "\n".join(para_texts)
+def detect_placeholders(file_path):
+    all_paragraphs = load_paragraphs(file_path)
+    # Merged table cells repeat the same <w:p> elements; derive their text and
+    # underline flag once per element.
+    text_cache = {}
+    underline_cache = {}
+    para_texts = []
+    for p in all_paragraphs:
+        text = text_cache.get(p)
+        if text is None:
+            text = text_cache[p] = paragraph_text(p)
+        para_texts.append(text)
 
-    bracketed = detect_bracketed(full_text)
-    signature = detect_signature_lines(all_paragraphs, para_texts, full_text)
+    # Single pass over paragraphs: bracket tokens and signature lines are found
+    # per paragraph, with absolute offsets/lines tracked as we go.
+    all_placeholders = []
+    para_offset = 0
+    line_base = 1
+    for para, text in zip(all_paragraphs, para_texts):
+        if text:
+            for match in _BRACKET_RE.finditer(text):
+                all_placeholders.append({
+                    "type": "bracketed",
+                    "value": match.group(0),
+                    "start": para_offset + match.start(),
+                    "end": para_offset + match.end(),
+                    "line": line_base + text.count("\n", 0, match.start())
+                })
+            sig = detect_signature_line(para, text, para_offset, line_base, underline_cache)
+            if sig:
+                all_placeholders.append(sig)
+        para_offset += len(text) + 1
+        line_base += text.count("\n") + 1
 
-    all_placeholders = bracketed + signature
-    all_placeholders.sort(key=lambda x: x['start'])
+    # Paragraph text joined the same way offsets were counted; only needed for context snippets
+    full_text = "\n".join(para_texts) if all_placeholders else ""
 
     # attach unique id, context and a heuristic label_guess
     for idx, p in enumerate(all_placeholders):
         start = max(0, p["start"] - CONTEXT_CHARS)
         end = min(len(full_text), p["end"] + CONTEXT_CHARS)
         snippet = full_text[start:end]
-        snippet = re.sub(r"[ \t]+", " ", snippet)
-        snippet = re.sub(r"\n{3,}", "\n\n", snippet)
+        snippet = _WS_RE.sub(" ", snippet)
+        snippet = _NL_RE.sub("\n\n", snippet)
         p["context"] = snippet
 
         # Unique stable ID per field (no collisions even if the token repeats)
         p["id"] = f"{p['type']}@L{p['line']}@{idx}"
 
-        # Heuristic label guess:
-        # 1) If immediately after a '$[____]' there is '("Some Term")' capture that term.
-        label_guess = None
-        if p["type"] == "bracketed" and p.get("value", "").startswith("$["):
-            m = re.search(r'\(\s*the\s+([^)â€â€œ"]+?)\s*\)', snippet, flags=re.IGNORECASE)
-            if m:
-                label_guess = m.group(1).strip()
-        # 2) For signature lines, keep the label itself
-        if p["type"] == "signature_line":
-            label_guess = p.get("label", None)
-        # 3) Fallback: nearest Capitalized Words before the bracket/colon
-        if not label_guess:
-            m2 = re.search(r'([A-Z][A-Za-z]+(?: [A-Z][A-Za-z]+){0,4})\s*(?:\$?\[\s*[_A-Za-z0-9]*\s*\]|:)\b', snippet)
-            if m2:
-                label_guess = m2.group(1).strip()
-
-        p["label_guess"] = label_guess or ""
+        p["label_guess"] = guess_label(p, snippet)
 
     return {
         "placeholders": all_placeholders,
@@ -60,66 +86,173 @@ def detect_placeholders(file_path):
         }
     }
 
-def detect_bracketed(full_text):
-    results = []
-    for match in re.finditer(r"\$?\[\s*[^\]\n]+\s*\]", full_text):
-        line = full_text.count("\n", 0, match.start()) + 1
-        results.append({
-            "type": "bracketed",
-            "value": match.group(0),
-            "start": match.start(),
-            "end": match.end(),
-            "line": line
-        })
-    return results
-
-def detect_signature_lines(paragraphs, para_texts, full_text):
-    results = []
-    para_offsets = build_offsets(para_texts)
-
-    for para_idx, (para, text) in enumerate(zip(paragraphs, para_texts)):
-        if not text:
-            continue
-        colon_pos = text.rfind(':')
-        if colon_pos == -1:
-            continue
-
-        after_colon = text[colon_pos + 1:]
-        if not after_colon or not all(c in (' ', '\t') for c in after_colon) or '\t' not in after_colon:
-            continue
-
-        label = text[:colon_pos].strip()
-        if '\n' in label:
-            label = label.split('\n')[-1].strip()
-
-        has_underline = any(run.font.underline for run in para.runs)
-        padding_start = para_offsets[para_idx] + colon_pos + 1
-        padding_end = para_offsets[para_idx] + len(text)
-        line = full_text.count("\n", 0, padding_start) + 1
-
-        num_tabs = after_colon.count('\t')
-        num_spaces = after_colon.count(' ')
-
-        results.append({
-            "type": "signature_line",
-            "label": label,
-            "start": padding_start,
-            "end": padding_end,
-            "line": line,
-            "metadata": {
-                "tabs": num_tabs,
-                "spaces": num_spaces,
-                "underlined": has_underline
-            }
-        })
-    return results
-
-def build_offsets(para_texts):
-    offsets = []
-    cur = 0
-    for i, text in enumerate(para_texts):
-        offsets.append(cur)
-        cur += len(text)
-        if i != len(para_texts) - 1:
-            cur += 1
-    return offsets
\ No newline at end of file
+def guess_label(p, snippet):
+    """
+    Heuristic label guess:
+    1) For '$[____]' fields, a '(the Some Term)' anywhere in the snippet wins.
+    2) For signature lines, keep the label itself.
+    3) Fallback: first Capitalized Words before a bracket/colon.
+    """
+    if p["type"] == "signature_line" and p.get("label"):
+        return p["label"]
+
+    if p["type"] != "bracketed" or not p.get("value", "").startswith("$["):
+        m = _LABEL_RE.search(snippet)
+        return m.group(1).strip() if m else ""
+
+    # One pass over the fused pattern: stop at the first paren term,
+    # remembering the first capitalized label in case there is none.
+    first_cap = None
+    for m in _LABEL_FUSED_RE.finditer(snippet):
+        paren = m.group("paren")
+        if paren is not None:
+            if paren.strip():
+                return paren.strip()
+            m = _LABEL_RE.search(snippet)
+            return m.group(1).strip() if m else ""
+        if first_cap is None:
+            first_cap = m.group("cap")
+    return first_cap.strip() if first_cap else ""
+
+def detect_signature_line(para, text, para_offset, line_base, underline_cache=None):
+    """Return a signature_line placeholder for 'Label:<tabs/spaces>' paragraphs, else None."""
+    colon_pos = text.rfind(':')
+    if colon_pos == -1:
+        return None
+
+    after_colon = text[colon_pos + 1:]
+    if not after_colon or not all(c in (' ', '\t') for c in after_colon) or '\t' not in after_colon:
+        return None
+
+    label = text[:colon_pos].strip()
+    if '\n' in label:
+        label = label.split('\n')[-1].strip()
+
+    # Underline is only looked up once the cheap textual checks above pass
+    if underline_cache is None:
+        has_underline = has_underlined_run(para)
+    else:
+        has_underline = underline_cache.get(para)
+        if has_underline is None:
+            has_underline = underline_cache[para] = has_underlined_run(para)
+    padding_start = para_offset + colon_pos + 1
+    padding_end = para_offset + len(text)
+    line = line_base + text.count("\n", 0, colon_pos + 1)
+
+    num_tabs = after_colon.count('\t')
+    num_spaces = after_colon.count(' ')
+
+    return {
+        "type": "signature_line",
+        "label": label,
+        "start": padding_start,
+        "end": padding_end,
+        "line": line,
+        "metadata": {
+            "tabs": num_tabs,
+            "spaces": num_spaces,
+            "underlined": has_underline
+        }
+    }
+
+# ---------- Raw WordprocessingML access ----------
+# Reads word/document.xml directly with lxml instead of building python-docx's
+# object tree; text/merge/underline rules mirror python-docx so results match.
+
+def _main_part_name(z):
+    """Zip name of the main document part, per the package's officeDocument relationship."""
+    try:
+        rels = etree.fromstring(z.read("_rels/.rels"), _XML_PARSER)
+    except KeyError:
+        return "word/document.xml"
+    for rel in rels.iter(f"{_PKG_REL}Relationship"):
+        if rel.get("Type", "").endswith("/officeDocument"):
+            return rel.get("Target", "").lstrip("/")
+    return "word/document.xml"
+
+def load_paragraphs(file_path):
+    """Body <w:p> elements followed by the paragraphs of each top-level table cell."""
+    with zipfile.ZipFile(file_path) as z:
+        root = etree.fromstring(z.read(_main_part_name(z)), _XML_PARSER)
+    body = root.find(f"{_W}body")
+    if body is None:
+        return []
+
+    paragraphs = body.findall(f"{_W}p")
+    for tbl in body.findall(f"{_W}tbl"):
+        for tc in _iter_table_cells(tbl):
+            paragraphs.extend(tc.findall(f"{_W}p"))
+    return paragraphs
+
+def _int_val(el, default):
+    if el is None:
+        return default
+    val = el.get(f"{_W}val")
+    return int(val) if val is not None else default
+
+def _grid_span(tc):
+    return _int_val(tc.find(f"{_W}tcPr/{_W}gridSpan"), 1)
+
+def _is_vmerge_continue(tc):
+    vmerge = tc.find(f"{_W}tcPr/{_W}vMerge")
+    return vmerge is not None and vmerge.get(f"{_W}val", "continue") == "continue"
+
+def _tc_at_grid_offset(tr, grid_offset):
+    remaining = grid_offset - _int_val(tr.find(f"{_W}trPr/{_W}gridBefore"), 0)
+    for tc in tr.findall(f"{_W}tc"):
+        if remaining < 0:
+            break
+        if remaining == 0:
+            return tc
+        remaining -= _grid_span(tc)
+    return None
+
+def _iter_table_cells(tbl):
+    """Cells row by row; spanned cells repeat and vertically merged cells resolve to the top cell."""
+    rows = tbl.findall(f"{_W}tr")
+    for row_idx, tr in enumerate(rows):
+        grid_offset = _int_val(tr.find(f"{_W}trPr/{_W}gridBefore"), 0)
+        for tc in tr.findall(f"{_W}tc"):
+            span = _grid_span(tc)
+            top, above_idx = tc, row_idx
+            while _is_vmerge_continue(top) and above_idx > 0:
+                above_idx -= 1
+                above = _tc_at_grid_offset(rows[above_idx], grid_offset)
+                if above is None:
+                    break
+                top = above
+            for _ in range(span):
+                yield top
+            grid_offset += span
+
+def _run_text(r):
+    parts = []
+    for el in r:
+        tag = el.tag
+        if tag == f"{_W}t":
+            parts.append(el.text or "")
+        elif tag in (f"{_W}tab", f"{_W}ptab"):
+            parts.append("\t")
+        elif tag == f"{_W}br":
+            # Page/column breaks have no text equivalent
+            if el.get(f"{_W}type", "textWrapping") == "textWrapping":
+                parts.append("\n")
+        elif tag == f"{_W}cr":
+            parts.append("\n")
+        elif tag == f"{_W}noBreakHyphen":
+            parts.append("-")
+    return "".join(parts)
+
+def paragraph_text(p):
+    """Text of runs and hyperlink runs, with tabs/line breaks as \\t/\\n."""
+    parts = []
+    for child in p:
+        if child.tag == f"{_W}r":
+            parts.append(_run_text(child))
+        elif child.tag == f"{_W}hyperlink":
+            parts.extend(_run_text(r) for r in child.findall(f"{_W}r"))
+    return "".join(parts)
+
+def has_underlined_run(p):
+    """True if any direct run sets an underline style other than 'none'."""
+    return bool(_UNDERLINE_XPATH(p))
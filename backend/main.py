@@ -1,14 +1,19 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Body
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from pathlib import Path
-import os, shutil, subprocess, uuid
-from typing import Dict, Any, List
+import os, asyncio, subprocess, uuid, hashlib, bisect, tempfile, multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
+import aiofiles
 import mammoth
+import orjson
 import re
 
 from detector import detect_placeholders
-from ai_processor import generate_field_guidance
+from ai_processor import generate_field_guidance, stream_field_guidance
 from docx import Document
 
 app = FastAPI()
@@ -23,14 +28,33 @@ app.add_middleware(
 BASE_DIR = Path(__file__).parent
 UPLOAD_DIR = BASE_DIR / "uploads"
 OUTPUT_DIR = BASE_DIR / "output"
+UPLOAD_CHUNK_SIZE = 1 << 16
+HTML_CACHE_DIR = OUTPUT_DIR / "html_cache"
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
+HTML_CACHE_DIR.mkdir(exist_ok=True)
+
+# DOCX -> PDF runs in worker processes; export returns a job id to poll.
+# Spawned, not forked: forking would copy the running event loop, the HTTP/2
+# client and any lock held by another thread into the worker.
+def _new_pdf_executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"))
+
+PDF_EXECUTOR = _new_pdf_executor()
+JOBS: Dict[str, Future] = {}
+MAX_JOBS = 500
 
 # ---------- Utilities ----------
 
 def _safe_name(name: str) -> str:
     return name.replace("/", "_").replace("\\", "_")
 
+def _detect_sorted(docx_path: Path) -> Dict[str, Any]:
+    results = detect_placeholders(str(docx_path))
+    # Sort by line number (document order) instead of by type
+    results["placeholders"].sort(key=lambda x: x['line'])
+    return results
+
 def docx_to_pdf(docx_path: Path) -> Path:
     """
     Convert DOCX → PDF. Tries docx2pdf; falls back to LibreOffice (soffice).
@@ -45,10 +69,12 @@ def docx_to_pdf(docx_path: Path) -> Path:
             return pdf_path
     except Exception:
         pass
-    # 2) Try LibreOffice
+    # 2) Try LibreOffice (per-process profile so parallel workers don't fight over the lock)
+    profile_dir = Path(tempfile.gettempdir()) / f"soffice-profile-{os.getpid()}"
     try:
         subprocess.run(
-            ["soffice", "--headless", "--convert-to", "pdf", "--outdir", str(OUTPUT_DIR), str(docx_path)],
+            ["soffice", f"-env:UserInstallation=file://{profile_dir}", "--headless",
+             "--convert-to", "pdf", "--outdir", str(OUTPUT_DIR), str(docx_path)],
             check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
         if pdf_path.exists():
@@ -57,24 +83,98 @@ def docx_to_pdf(docx_path: Path) -> Path:
         raise HTTPException(status_code=500, detail=f"PDF conversion failed: {e}")
     raise HTTPException(status_code=500, detail="PDF conversion failed")
 
-def create_marked_html(docx_path: Path, placeholders: List[Dict[str, Any]]) -> str:
+def _bracket_html_pattern(value: str) -> str:
+    # Build a pattern that allows HTML tags between any characters
+    chars = []
+    in_bracket = False
+    for char in value:
+        if char == '[':
+            chars.append(r'\[(?:<[^>]+>)*')
+            in_bracket = True
+        elif char == ']':
+            chars.append(r'(?:<[^>]+>)*\]')
+            in_bracket = False
+        elif char == '$':
+            chars.append(r'\$(?:<[^>]+>)*')
+        elif in_bracket and char not in ' \t\n':
+            # Allow HTML tags between characters inside brackets
+            chars.append(re.escape(char) + r'(?:<[^>]+>)*')
+        else:
+            chars.append(re.escape(char))
+    return ''.join(chars)
+
+def _pdf_job(docx_path: Path) -> str:
+    """Process-pool entry point: returns the PDF file name (plain errors pickle cleanly)."""
+    try:
+        return docx_to_pdf(docx_path).name
+    except HTTPException as e:
+        raise RuntimeError(e.detail)
+
+def _submit_pdf_job(docx_path: Path) -> Optional[str]:
+    """Queue a PDF conversion; None if no worker pool can take it."""
+    global PDF_EXECUTOR
+    # Drop the oldest finished jobs once the table is full
+    if len(JOBS) >= MAX_JOBS:
+        for job_id in [j for j, f in JOBS.items() if f.done()][:len(JOBS) - MAX_JOBS + 1]:
+            JOBS.pop(job_id, None)
+    try:
+        future = PDF_EXECUTOR.submit(_pdf_job, docx_path)
+    except BrokenProcessPool:
+        # A worker died (soffice crash, OOM) and took the pool with it: start a fresh one
+        PDF_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        PDF_EXECUTOR = _new_pdf_executor()
+        try:
+            future = PDF_EXECUTOR.submit(_pdf_job, docx_path)
+        except Exception:
+            return None
+    job_id = uuid.uuid4().hex
+    JOBS[job_id] = future
+    return job_id
+
+@lru_cache(maxsize=32)
+def _mammoth_html(path: str, mtime_ns: int) -> str:
+    """DOCX -> HTML via mammoth; mtime_ns is part of the key so edits invalidate it."""
+    with open(path, "rb") as docx_file:
+        return mammoth.convert_to_html(docx_file).value
+
+def docx_html(docx_path: Path) -> str:
+    return _mammoth_html(str(docx_path), docx_path.stat().st_mtime_ns)
+
+def create_marked_html(html: str, placeholders: List[Dict[str, Any]]) -> str:
     """
-    Convert DOCX to HTML and insert unique markers at detected field positions.
+    Insert unique markers into the document HTML at detected field positions.
     Handles HTML tags that may appear within bracketed fields.
+
+    All marker spans are located against the original HTML first, then the
+    output is assembled in one join (no per-field copy of the whole string).
     """
-    # Convert to HTML
-    with open(docx_path, "rb") as docx_file:
-        result = mammoth.convert_to_html(docx_file)
-        html = result.value
-    
     # Sort placeholders by start position (process in document order)
     sorted_placeholders = sorted(placeholders, key=lambda x: x['start'])
     
-    # Track which labels we've seen for duplicate handling
+    # (start, end, replacement) spans; claimed_starts/claimed_ends kept sorted for overlap checks
+    edits = []
+    claimed_starts: List[int] = []
+    claimed_ends: List[int] = []
+
+    def _is_free(start: int, end: int) -> bool:
+        i = bisect.bisect_right(claimed_starts, start)
+        if i > 0 and claimed_ends[i - 1] > start:
+            return False
+        return i == len(claimed_starts) or claimed_starts[i] >= end
+
+    def _claim(start: int, end: int, replacement: str) -> None:
+        i = bisect.bisect_right(claimed_starts, start)
+        claimed_starts.insert(i, start)
+        claimed_ends.insert(i, end)
+        edits.append((start, end, replacement))
+
+    # Each distinct pattern is scanned once; identical tokens consume successive matches
+    bracket_matches: Dict[str, List[Any]] = {}
+    bracket_cursor: Dict[str, int] = {}
+    label_matches: Dict[str, List[Any]] = {}
     label_counts = {}
     
-    # Process each placeholder in order
-    for idx, placeholder in enumerate(sorted_placeholders):
+    for placeholder in sorted_placeholders:
         field_type = placeholder['type']
         field_id = placeholder['id']
         marker = f'<span class="field-marker" data-field-id="{field_id}">__MARKER_{field_id}__</span>'
@@ -82,35 +182,25 @@ def create_marked_html(docx_path: Path, placeholders: List[Dict[str, Any]]) -> s
         if field_type == 'bracketed':
             # For bracketed fields like [COMPANY NAME] or $[Amount]
             value = placeholder['value']
-            
-            # Build a pattern that allows HTML tags between any characters
-            chars = []
-            in_bracket = False
-            for char in value:
-                if char == '[':
-                    chars.append(r'\[(?:<[^>]+>)*')
-                    in_bracket = True
-                elif char == ']':
-                    chars.append(r'(?:<[^>]+>)*\]')
-                    in_bracket = False
-                elif char == '$':
-                    chars.append(r'\$(?:<[^>]+>)*')
-                elif in_bracket and char not in ' \t\n':
-                    # Allow HTML tags between characters inside brackets
-                    chars.append(re.escape(char) + r'(?:<[^>]+>)*')
-                else:
-                    chars.append(re.escape(char))
-            
-            pattern = ''.join(chars)
-            
-            # Try to find and replace
-            match = re.search(pattern, html, re.IGNORECASE)
-            if match:
-                html = html[:match.start()] + marker + html[match.end():]
+            pattern = _bracket_html_pattern(value)
+            if pattern not in bracket_matches:
+                bracket_matches[pattern] = list(re.finditer("(?i)" + pattern, html))
+                bracket_cursor[pattern] = 0
+
+            matches = bracket_matches[pattern]
+            i = bracket_cursor[pattern]
+            while i < len(matches) and not _is_free(matches[i].start(), matches[i].end()):
+                i += 1
+            if i < len(matches):
+                _claim(matches[i].start(), matches[i].end(), marker)
+                bracket_cursor[pattern] = i + 1
             else:
                 # Fallback: try simple replacement
-                if value in html:
-                    html = html.replace(value, marker, 1)
+                pos = html.find(value)
+                while pos != -1 and not _is_free(pos, pos + len(value)):
+                    pos = html.find(value, pos + 1)
+                if pos != -1:
+                    _claim(pos, pos + len(value), marker)
                 
         elif field_type == 'signature_line':
             # For signature lines like "By: _______"
@@ -119,29 +209,94 @@ def create_marked_html(docx_path: Path, placeholders: List[Dict[str, Any]]) -> s
             # Track how many times we've seen this label
             if label not in label_counts:
                 label_counts[label] = 0
+                # Match label: followed by spaces/tabs/whitespace, allowing HTML tags
+                pattern = f"({re.escape(label)}:)((?:<[^>]+>|\\s)+)"
+                label_matches[label] = list(re.finditer(pattern, html))
             
-            # Find all occurrences of "Label:" followed by whitespace
-            escaped_label = re.escape(label)
-            # Match label: followed by spaces/tabs/whitespace, allowing HTML tags
-            pattern = f"({escaped_label}:)((?:<[^>]+>|\\s)+)"
-            
-            # Find all matches
-            matches = list(re.finditer(pattern, html))
-            
+            matches = label_matches[label]
             if label_counts[label] < len(matches):
-                # Get the nth occurrence (where n = label_counts[label])
+                # Take the nth occurrence; keep the label and colon, replace the whitespace with marker
                 match = matches[label_counts[label]]
-                
-                # Replace this specific occurrence
-                before = html[:match.start()]
-                after = html[match.end():]
-                
-                # Keep the label and colon, replace the whitespace with marker
-                replacement = match.group(1) + ' ' + marker
-                html = before + replacement + after
-                
+                if _is_free(match.start(2), match.end(2)):
+                    _claim(match.start(2), match.end(2), ' ' + marker)
                 label_counts[label] += 1
-    
+
+    out_parts = []
+    cursor = 0
+    for start, end, replacement in sorted(edits):
+        if start < cursor:
+            continue
+        out_parts.append(html[cursor:start])
+        out_parts.append(replacement)
+        cursor = end
+    out_parts.append(html[cursor:])
+    return "".join(out_parts)
+
+def _splice_paragraph(para, text: str, spans: List[Tuple[int, int, str]]) -> str:
+    """
+    Replace (start, end) spans of the paragraph text with new values, editing only
+    the runs the spans touch so the rest of the paragraph keeps its formatting.
+    A replacement takes the formatting of the run the span starts in.
+    Returns the new paragraph text.
+    """
+    runs = para.runs
+    if "".join(r.text for r in runs) != text:
+        # Text lives outside plain runs (e.g. hyperlinks): fall back to a flat rewrite
+        out, cursor = [], 0
+        for start, end, value in spans:
+            out.append(text[cursor:start])
+            out.append(value)
+            cursor = end
+        para.text = "".join(out) + text[cursor:]
+        return para.text
+
+    bounds = []
+    pos = 0
+    for r in runs:
+        bounds.append((pos, pos + len(r.text)))
+        pos += len(r.text)
+
+    def _run_at(offset: int) -> int:
+        for i, (_, e) in enumerate(bounds):
+            if offset < e:
+                return i
+        return len(bounds) - 1
+
+    # Right-to-left so earlier offsets stay valid
+    for start, end, value in sorted(spans, reverse=True):
+        first = _run_at(start)
+        last = _run_at(end - 1) if end > start else first
+        fs, ls = bounds[first][0], bounds[last][0]
+        if first == last:
+            t = runs[first].text
+            runs[first].text = t[:start - fs] + value + t[end - fs:]
+        else:
+            runs[first].text = runs[first].text[:start - fs] + value
+            for i in range(first + 1, last):
+                runs[i].text = ""
+            runs[last].text = runs[last].text[end - ls:]
+    return "".join(r.text for r in runs)
+
+def cached_marked_html(docx_path: Path, placeholders: List[Dict[str, Any]]) -> str:
+    """
+    create_marked_html memoized on disk by (DOCX bytes, marker-relevant placeholder fields),
+    so re-uploading the same template skips the mammoth conversion and marker pass.
+    """
+    marker_fields = [
+        {k: p.get(k) for k in ("id", "type", "value", "label", "start")}
+        for p in placeholders
+    ]
+    h = hashlib.sha256(docx_path.read_bytes())
+    h.update(orjson.dumps(marker_fields, option=orjson.OPT_SORT_KEYS))
+    cache_path = HTML_CACHE_DIR / f"{h.hexdigest()}.html"
+
+    if cache_path.exists():
+        return cache_path.read_text(encoding="utf-8")
+
+    html = create_marked_html(docx_html(docx_path), placeholders)
+    tmp_path = cache_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    tmp_path.write_text(html, encoding="utf-8")
+    os.replace(tmp_path, cache_path)
     return html
 
 def fill_docx_placeholders(src_docx: Path, placeholders: List[Dict[str, Any]]) -> Path:
@@ -164,15 +319,21 @@ def fill_docx_placeholders(src_docx: Path, placeholders: List[Dict[str, Any]]) -
         else:
             sig_map[f'{p["label"]}:'] = user_val
 
+    # One alternation for all tokens (longest first so "$[X]" wins over "[X]")
+    bracket_re = re.compile("|".join(re.escape(k) for k in sorted(bracket_map, key=len, reverse=True))) if bracket_map else None
+
     def _replace_text_in_run_container(container, replacer):
         for para in container.paragraphs:
-            for k, v in list(bracket_map.items()):
-                if k in para.text:
-                    para.text = para.text.replace(k, v)
-            for k, v in list(sig_map.items()):
-                if k in para.text:
-                    parts = para.text.rsplit(k, 1)
-                    para.text = (parts[0] + k + " " + v) if len(parts) == 2 else para.text
+            text = para.text
+            spans = []
+            if bracket_re and bracket_re.search(text):
+                spans = [(m.start(), m.end(), bracket_map[m.group(0)]) for m in bracket_re.finditer(text)]
+            if spans:
+                text = _splice_paragraph(para, text, spans)
+            for k, v in sig_map.items():
+                pos = text.rfind(k)
+                if pos != -1:
+                    text = _splice_paragraph(para, text, [(pos + len(k), len(text), " " + v)])
 
         for table in container.tables:
             for row in table.rows:
@@ -188,23 +349,23 @@ def fill_docx_placeholders(src_docx: Path, placeholders: List[Dict[str, Any]]) -
 # ---------- API ----------
 
 @app.post("/api/upload")
-async def upload_document(file: UploadFile = File(...)):
+async def upload_document(file: UploadFile = File(...), stream_hints: bool = False):
     if not file.filename.endswith(".docx"):
         raise HTTPException(status_code=400, detail="Only .docx files supported")
 
     safe = _safe_name(file.filename)
     docx_path = UPLOAD_DIR / safe
-    with open(docx_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    async with aiofiles.open(docx_path, "wb") as buffer:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await buffer.write(chunk)
 
     # Detect placeholders
-    results = detect_placeholders(str(docx_path))
-    
-    # Sort by line number (document order) instead of by type
-    results["placeholders"].sort(key=lambda x: x['line'])
+    results = await asyncio.to_thread(_detect_sorted, docx_path)
 
-    # Generate AI hints
-    guidance = generate_field_guidance(safe, results["placeholders"], pdf_path=None)
+    # Generate AI hints (or let the client pull them from /api/guidance as they complete)
+    guidance = {}
+    if not stream_hints:
+        guidance = await generate_field_guidance(safe, results["placeholders"], pdf_path=None)
 
     attached = 0
     for p in results["placeholders"]:
@@ -218,19 +379,40 @@ async def upload_document(file: UploadFile = File(...)):
     # Generate pre-marked HTML for live preview
     marked_html = None
     try:
-        marked_html = create_marked_html(docx_path, results["placeholders"])
+        marked_html = await asyncio.to_thread(cached_marked_html, docx_path, results["placeholders"])
     except Exception:
         pass
 
-    return {
+    # Serialized with orjson directly: this payload carries the full marked_html
+    return Response(orjson.dumps({
         "success": True,
         "filename": safe,
         "placeholders": results["placeholders"],
         "summary": results["summary"],
         "marked_html": marked_html,
         "pdf_url": None,
-        "ai_hints_enabled": len(guidance) > 0
-    }
+        "ai_hints_enabled": len(guidance) > 0,
+        "guidance_url": f"/api/guidance/{safe}" if stream_hints else None
+    }), media_type="application/json")
+
+@app.get("/api/guidance/{name}")
+async def stream_guidance(name: str):
+    """
+    Server-sent events: one `data: {id, micro, long, demo}` message per field
+    as soon as its guidance is ready, then a final `done` event.
+    """
+    docx_path = UPLOAD_DIR / _safe_name(name)
+    if not docx_path.exists():
+        raise HTTPException(status_code=404, detail="Source DOCX not found")
+
+    results = await asyncio.to_thread(_detect_sorted, docx_path)
+
+    async def events():
+        async for field_id, guidance in stream_field_guidance(docx_path.name, results["placeholders"]):
+            yield b"data: " + orjson.dumps({"id": field_id, **guidance}) + b"\n\n"
+        yield b"event: done\ndata: {}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 @app.post("/api/export")
 async def export_filled(payload: Dict[str, Any] = Body(...)):
@@ -251,14 +433,28 @@ async def export_filled(payload: Dict[str, Any] = Body(...)):
     resp = {"filled_docx_url": f"/api/file/{filled_docx.name}"}
 
     if also_pdf:
-        try:
-            filled_pdf = docx_to_pdf(filled_docx)
-            resp["filled_pdf_url"] = f"/api/file/{filled_pdf.name}"
-        except Exception:
-            resp["filled_pdf_url"] = None
+        # Conversion can take several seconds; poll /api/job/{job_id} for the PDF URL
+        job_id = _submit_pdf_job(filled_docx)
+        resp["filled_pdf_url"] = None
+        if job_id:
+            resp["job_id"] = job_id
+            resp["job_url"] = f"/api/job/{job_id}"
 
     return resp
 
+@app.get("/api/job/{job_id}")
+async def get_job(job_id: str):
+    future = JOBS.get(job_id)
+    if future is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not future.done():
+        return {"job_id": job_id, "status": "pending"}
+    try:
+        pdf_name = future.result()
+    except Exception as e:
+        return {"job_id": job_id, "status": "failed", "error": str(e), "filled_pdf_url": None}
+    return {"job_id": job_id, "status": "done", "filled_pdf_url": f"/api/file/{pdf_name}"}
+
 @app.get("/api/file/{name}")
 async def get_file(name: str):
     path = (OUTPUT_DIR / name) if (OUTPUT_DIR / name).exists() else (UPLOAD_DIR / name)
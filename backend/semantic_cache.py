@@ -0,0 +1,122 @@
+# semantic_cache.py
+"""
+Near-match lookup for field guidance: fields whose (token, type, label_guess,
+context) embed within SIMILARITY_THRESHOLD cosine of an earlier field reuse its guidance.
+
+Optional: needs onnxruntime, tokenizers, faiss and numpy, plus a MiniLM
+(all-MiniLM-L6-v2) ONNX export in GUIDANCE_EMBED_MODEL_DIR containing
+model.onnx and tokenizer.json. Without them `enabled()` is False and callers
+fall back to the exact-match cache.
+"""
+import os, threading, uuid
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple
+
+try:
+    import numpy as np
+    import orjson
+    import onnxruntime as ort
+    import faiss
+    from tokenizers import Tokenizer
+    _HAVE_DEPS = True
+except Exception:
+    _HAVE_DEPS = False
+
+MODEL_DIR = Path(os.environ.get("GUIDANCE_EMBED_MODEL_DIR", Path(__file__).parent / "models" / "all-MiniLM-L6-v2"))
+INDEX_DIR = Path(os.environ.get("GUIDANCE_INDEX_DIR", Path(__file__).parent / "output" / "guidance_index"))
+SIMILARITY_THRESHOLD = 0.92
+MAX_TOKENS = 256
+
+_lock = threading.Lock()
+_state: Dict[str, Any] = {}
+
+def enabled() -> bool:
+    return _HAVE_DEPS and (MODEL_DIR / "model.onnx").exists() and (MODEL_DIR / "tokenizer.json").exists()
+
+def _load() -> Dict[str, Any]:
+    """Lazily load the ONNX session, tokenizer and persisted index (once per process)."""
+    if _state:
+        return _state
+    with _lock:
+        if _state:
+            return _state
+        tokenizer = Tokenizer.from_file(str(MODEL_DIR / "tokenizer.json"))
+        tokenizer.enable_truncation(MAX_TOKENS)
+        tokenizer.enable_padding()
+        session = ort.InferenceSession(str(MODEL_DIR / "model.onnx"), providers=["CPUExecutionProvider"])
+        dim = session.get_outputs()[0].shape[-1]
+
+        index, payloads = _read_index(dim)
+        if index is None:
+            index, payloads = faiss.IndexFlatIP(dim), []
+
+        _state.update(tokenizer=tokenizer, session=session, index=index, payloads=payloads)
+    return _state
+
+def _read_index(dim: int) -> Tuple[Any, List[Dict[str, str]]]:
+    """Persisted (index, payloads), or (None, []) if missing, unreadable or out of step.
+
+    payloads.json records the vector count it was written with; a pair whose
+    counts disagree (crash between the two writes, another worker's file) would
+    hand out guidance by the wrong position, so it is discarded.
+    """
+    index_path, payload_path = INDEX_DIR / "index.faiss", INDEX_DIR / "payloads.json"
+    if not (index_path.exists() and payload_path.exists()):
+        return None, []
+    try:
+        index = faiss.read_index(str(index_path))
+        stored = orjson.loads(payload_path.read_bytes())
+        payloads = stored["payloads"]
+        if index.d != dim or not (index.ntotal == stored["ntotal"] == len(payloads)):
+            return None, []
+    except Exception:
+        return None, []
+    return index, payloads
+
+def _replace(path: Path, write) -> None:
+    """Write via a temp file and os.replace, so readers never see a partial file."""
+    tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def embed(texts: List[str]) -> "np.ndarray":
+    """One batched session.run over all texts; mean-pooled, L2-normalized vectors."""
+    st = _load()
+    encodings = st["tokenizer"].encode_batch(texts)
+    ids = np.array([e.ids for e in encodings], dtype=np.int64)
+    mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+    feeds = {"input_ids": ids, "attention_mask": mask}
+    if any(i.name == "token_type_ids" for i in st["session"].get_inputs()):
+        feeds["token_type_ids"] = np.zeros_like(ids)
+
+    hidden = st["session"].run(None, feeds)[0]
+    m = mask[..., None].astype(np.float32)
+    vectors = (hidden * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+    vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+    return vectors.astype(np.float32)
+
+def lookup(vectors: "np.ndarray") -> List[Optional[Dict[str, str]]]:
+    """Best cached guidance per vector, or None below SIMILARITY_THRESHOLD."""
+    st = _load()
+    with _lock:
+        if st["index"].ntotal == 0:
+            return [None] * len(vectors)
+        scores, idx = st["index"].search(vectors, 1)
+        payloads = st["payloads"]
+    return [
+        dict(payloads[i]) if i >= 0 and s >= SIMILARITY_THRESHOLD else None
+        for s, i in zip(scores[:, 0], idx[:, 0])
+    ]
+
+def add(entries: List[Tuple["np.ndarray", Dict[str, str]]]) -> None:
+    """Index new (vector, guidance) pairs and persist index + payloads (each replaced atomically)."""
+    if not entries:
+        return
+    st = _load()
+    with _lock:
+        st["index"].add(np.stack([v for v, _ in entries]))
+        st["payloads"].extend(g for _, g in entries)
+        INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        _replace(INDEX_DIR / "index.faiss", lambda tmp: faiss.write_index(st["index"], str(tmp)))
+        stored = orjson.dumps({"ntotal": st["index"].ntotal, "payloads": st["payloads"]})
+        _replace(INDEX_DIR / "payloads.json", lambda tmp: tmp.write_bytes(stored))
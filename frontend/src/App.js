@@ -30,6 +30,20 @@ function App() {
   const fieldsRef = useRef(null);
   const fileInputRef = useRef(null);
   const chatMessagesRef = useRef(null);
+  const guidanceSourceRef = useRef(null);
+  const currentFilenameRef = useRef('');
+
+  const closeGuidanceStream = () => {
+    if (guidanceSourceRef.current) {
+      guidanceSourceRef.current.close();
+      guidanceSourceRef.current = null;
+    }
+  };
+
+  // Don't leave a hint stream open after the app unmounts
+  useEffect(() => () => {
+    if (guidanceSourceRef.current) guidanceSourceRef.current.close();
+  }, []);
 
   // Auto-scroll chat to bottom when messages update
   useEffect(() => {
@@ -42,18 +56,22 @@ function App() {
     const file = e.target.files?.[0];
     if (!file) return;
 
+    // A previous document's hints must not land on this one (field ids repeat across documents)
+    closeGuidanceStream();
+    currentFilenameRef.current = '';
     setView('loading');
     const formData = new FormData();
     formData.append('file', file);
 
     try {
-      const res = await fetch(`${API_BASE}/api/upload`, {
+      const res = await fetch(`${API_BASE}/api/upload?stream_hints=true`, {
         method: 'POST',
         body: formData
       });
       const data = await res.json();
 
       setFilename(data.filename);
+      currentFilenameRef.current = data.filename;
       setPlaceholders(data.placeholders);
       setMarkedHtml(data.marked_html || '');
       
@@ -72,6 +90,31 @@ function App() {
       }]);
 
       setView('app');
+
+      // AI hints arrive field-by-field over server-sent events
+      if (data.guidance_url) {
+        const streamFilename = data.filename;
+        const source = new EventSource(`${API_BASE}${data.guidance_url}`);
+        guidanceSourceRef.current = source;
+        const stop = () => {
+          source.close();
+          if (guidanceSourceRef.current === source) guidanceSourceRef.current = null;
+        };
+        source.onmessage = (event) => {
+          if (currentFilenameRef.current !== streamFilename) {
+            stop();
+            return;
+          }
+          const g = JSON.parse(event.data);
+          setPlaceholders(prev => prev.map(p => (
+            p.id === g.id
+              ? { ...p, hint: g.micro || '', hint_long: g.long || '', demo_value: g.demo || '' }
+              : p
+          )));
+        };
+        source.addEventListener('done', stop);
+        source.onerror = stop;
+      }
     } catch (err) {
       console.error('Upload error:', err);
       setView('initial');